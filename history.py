@@ -0,0 +1,404 @@
+#! /usr/bin/env python
+
+"""
+Local telemetry history: append-only columnar segments and a query CLI
+
+Each UTC day is a segment directory. Inside it every series (one
+location/controller/measurement/outlet combination) has a time column
+(<id>.t) and a value column (<id>.v) of native float64s. Points older than
+the last one written to their column are rejected, so the time column is
+always sorted and doubles as the index for range lookups.
+"""
+import argparse
+import array
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+
+HISTORY_DIR = os.path.expanduser("~/history")
+SERIES_FILE = "series.json"
+TIME_COLUMN = ".t"
+VALUE_COLUMN = ".v"
+ITEM_SIZE = struct.calcsize('d')
+
+# Buffer this many points before writing them out
+FLUSH_POINTS = 500
+# While flushes are failing, keep at most this many points, dropping the oldest
+MAX_PENDING_POINTS = 10*FLUSH_POINTS
+
+# Gaps between running_heater samples longer than this aren't counted as runtime
+RUNTIME_MAX_GAP = 10*60
+
+
+def segmentName(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d")
+
+
+def loadSeries(path):
+    series_file = os.path.join(path, SERIES_FILE)
+    if os.path.isfile(series_file):
+        with open(series_file) as f:
+            return [tuple(s) for s in json.loads(f.read())]
+    return []
+
+
+def fromBytes(data):
+    values = array.array('d')
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+class HistoryArchive(object):
+    '''
+    Append-only writer. Points are held in memory until flush().
+    '''
+    def __init__(self, path=HISTORY_DIR):
+        self.Path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.Series = loadSeries(path)
+        self.SeriesIds = dict((s, i) for i, s in enumerate(self.Series))
+        self.Segment = None
+        self.Pending = {}
+        self.PendingCount = 0
+        self.Checked = set()
+        # Newest time written per (segment, series), and points rejected
+        # because the clock went backwards
+        self.LastTimes = {}
+        self.Rejected = 0
+        # Points dropped because they couldn't be written
+        self.Dropped = 0
+
+    def _seriesId(self, key):
+        if key not in self.SeriesIds:
+            self.SeriesIds[key] = len(self.Series)
+            self.Series.append(key)
+            # Write then rename so a power cut never leaves a truncated file.
+            # Losing it would reuse ids on top of existing columns.
+            series_file = os.path.join(self.Path, SERIES_FILE)
+            with open(series_file + ".tmp", "w") as f:
+                f.write(json.dumps(self.Series))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(series_file + ".tmp", series_file)
+        return self.SeriesIds[key]
+
+    def _lastTime(self, segment, series):
+        key = (segment, series)
+        if key not in self.LastTimes:
+            prefix = os.path.join(self.Path, segment, str(series))
+            t = Column(prefix + TIME_COLUMN)
+            v = Column(prefix + VALUE_COLUMN)
+            try:
+                rows = min(t.Rows, v.Rows)
+                self.LastTimes[key] = t[rows - 1] if rows > 0 else None
+            finally:
+                t.close()
+                v.close()
+        return self.LastTimes[key]
+
+    def append(self, location, controller, measurement, outlet, value, timestamp):
+        '''
+        Returns False if the point was rejected for being older than the last
+        point in its series
+        '''
+        value = float(value)
+        segment = segmentName(timestamp)
+        series = self._seriesId((str(location), str(controller), str(measurement), str(outlet)))
+        last = self._lastTime(segment, series)
+        if last is not None and timestamp < last:
+            self.Rejected += 1
+            return False
+
+        if segment != self.Segment:
+            if not self._tryFlush():
+                # Pending points can only go to their own segment
+                self.Dropped += self.PendingCount
+                self.Pending = {}
+                self.PendingCount = 0
+            self.Segment = segment
+
+        if self.PendingCount >= MAX_PENDING_POINTS:
+            self._dropOldest()
+
+        self.LastTimes[(segment, series)] = timestamp
+        times, values = self.Pending.setdefault(series, (array.array('d'), array.array('d')))
+        times.append(timestamp)
+        values.append(value)
+        self.PendingCount += 1
+
+        if self.PendingCount >= FLUSH_POINTS:
+            self._tryFlush()
+        return True
+
+    def _tryFlush(self):
+        # Failures are left for the next explicit flush() to report
+        try:
+            self.flush()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _dropOldest(self):
+        oldest = None
+        for series, (times, values) in self.Pending.items():
+            if len(times) > 0 and (oldest is None or times[0] < self.Pending[oldest][0][0]):
+                oldest = series
+        times, values = self.Pending[oldest]
+        times.pop(0)
+        values.pop(0)
+        self.PendingCount -= 1
+        self.Dropped += 1
+
+    def _repair(self, prefix):
+        # A crash between the two column writes leaves one column longer.
+        # Trim both back to the rows that are complete.
+        sizes = self._sizes(prefix)
+        rows = min(sizes)//ITEM_SIZE
+        for column, size in zip((TIME_COLUMN, VALUE_COLUMN), sizes):
+            if size != rows*ITEM_SIZE:
+                with open(prefix + column, "r+b") as f:
+                    f.truncate(rows*ITEM_SIZE)
+
+    def _sizes(self, prefix):
+        sizes = []
+        for column in (TIME_COLUMN, VALUE_COLUMN):
+            if os.path.isfile(prefix + column):
+                sizes.append(os.path.getsize(prefix + column))
+            else:
+                sizes.append(0)
+        return sizes
+
+    def _rollback(self, prefix, sizes, key):
+        try:
+            for column, size in zip((TIME_COLUMN, VALUE_COLUMN), sizes):
+                if os.path.isfile(prefix + column):
+                    with open(prefix + column, "r+b") as f:
+                        f.truncate(size)
+        except (IOError, OSError):
+            # Couldn't roll back, so check the columns again on the next flush
+            self.Checked.discard(key)
+
+    def flush(self):
+        if self.PendingCount == 0:
+            return
+
+        directory = os.path.join(self.Path, self.Segment)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Series are removed from Pending as soon as both columns are written,
+        # so a failed flush only replays the series that didn't make it
+        for series in list(self.Pending.keys()):
+            times, values = self.Pending[series]
+            prefix = os.path.join(directory, str(series))
+            key = (self.Segment, series)
+            if key not in self.Checked:
+                self._repair(prefix)
+                self.Checked.add(key)
+
+            sizes = self._sizes(prefix)
+            try:
+                with open(prefix + TIME_COLUMN, "ab") as f:
+                    times.tofile(f)
+                with open(prefix + VALUE_COLUMN, "ab") as f:
+                    values.tofile(f)
+            except:
+                # Keep the columns the same length so rows stay paired
+                self._rollback(prefix, sizes, key)
+                raise
+
+            del self.Pending[series]
+            self.PendingCount -= len(times)
+
+
+class Column(object):
+    '''
+    Memory mapped float64 column
+    '''
+    def __init__(self, filename):
+        self.File = None
+        self.Map = None
+        self.Rows = 0
+        if os.path.isfile(filename) and os.path.getsize(filename) >= ITEM_SIZE:
+            self.File = open(filename, "rb")
+            self.Map = mmap.mmap(self.File.fileno(), 0, access=mmap.ACCESS_READ)
+            self.Rows = len(self.Map)//ITEM_SIZE
+
+    def __getitem__(self, i):
+        return struct.unpack_from('d', self.Map, i*ITEM_SIZE)[0]
+
+    def bisect(self, value, rows):
+        # first row >= value
+        lo, hi = 0, rows
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def values(self, start, end):
+        if end <= start:
+            return array.array('d')
+        return fromBytes(self.Map[start*ITEM_SIZE:end*ITEM_SIZE])
+
+    def close(self):
+        if self.Map is not None:
+            self.Map.close()
+            self.File.close()
+
+
+class HistoryReader(object):
+    def __init__(self, path=HISTORY_DIR):
+        self.Path = path
+        self.Series = loadSeries(path)
+
+    def findSeries(self, measurement=None, outlet=None, controller=None, location=None):
+        ids = []
+        for i, (l, c, m, o) in enumerate(self.Series):
+            if measurement is not None and m != measurement:
+                continue
+            if outlet is not None and o != outlet:
+                continue
+            if controller is not None and c != controller:
+                continue
+            if location is not None and l != location:
+                continue
+            ids.append(i)
+        return ids
+
+    def segments(self, start, end):
+        first = segmentName(start)
+        last = segmentName(end)
+        names = []
+        if os.path.isdir(self.Path):
+            for name in sorted(os.listdir(self.Path)):
+                if name.isdigit() and first <= name <= last:
+                    names.append(name)
+        return names
+
+    def read(self, series, start, end):
+        '''
+        Times and values for a series between start and end (epoch seconds)
+        '''
+        times = array.array('d')
+        values = array.array('d')
+        for segment in self.segments(start, end):
+            prefix = os.path.join(self.Path, segment, str(series))
+            t = Column(prefix + TIME_COLUMN)
+            v = Column(prefix + VALUE_COLUMN)
+            try:
+                rows = min(t.Rows, v.Rows)
+                if rows == 0:
+                    continue
+                first = t.bisect(start, rows)
+                last = t.bisect(end, rows)
+                times.extend(t.values(first, last))
+                values.extend(v.values(first, last))
+            finally:
+                t.close()
+                v.close()
+        return times, values
+
+    def stats(self, series, start, end):
+        times, values = self.read(series, start, end)
+        if len(values) == 0:
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "min": min(values),
+            "max": max(values),
+            "mean": sum(values)/len(values),
+        }
+
+    def runtime(self, series, start, end):
+        '''
+        Seconds a heater was running, from its running_heater samples
+        '''
+        times, values = self.read(series, start, end)
+        seconds = 0.0
+        for i in range(len(times) - 1):
+            if values[i] >= 1:
+                gap = times[i + 1] - times[i]
+                if gap <= RUNTIME_MAX_GAP:
+                    seconds += gap
+        return seconds
+
+
+def parseTime(value):
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            t = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return (t - datetime.datetime(1970, 1, 1)).total_seconds()
+    raise argparse.ArgumentTypeError("Unrecognized time '%s'"%(value))
+
+
+def formatTime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def seriesName(series):
+    return "%s/%s %s[%s]"%series
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the local telemetry history. Times are UTC.")
+    parser.add_argument("--path", default=HISTORY_DIR)
+    parser.add_argument("--start", type=parseTime, help="YYYY-MM-DD[ HH:MM], defaults to --days ago")
+    parser.add_argument("--end", type=parseTime, help="YYYY-MM-DD[ HH:MM], defaults to now")
+    parser.add_argument("--days", type=float, default=1.0)
+    parser.add_argument("--controller")
+    parser.add_argument("--location")
+    parser.add_argument("--outlet")
+    parser.add_argument("command", choices=["series", "range", "stats", "runtime"])
+    parser.add_argument("measurement", nargs="?")
+    args = parser.parse_args(argv)
+
+    end = args.end
+    if end is None:
+        end = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()
+    start = args.start
+    if start is None:
+        start = end - args.days*24*3600
+
+    reader = HistoryReader(args.path)
+    measurement = args.measurement
+    if args.command == "runtime":
+        measurement = "running_heater"
+    elif args.command != "series" and measurement is None:
+        parser.error("%s needs a measurement"%(args.command))
+
+    ids = reader.findSeries(measurement, args.outlet, args.controller, args.location)
+
+    for series in ids:
+        name = seriesName(reader.Series[series])
+        if args.command == "series":
+            print(name)
+        elif args.command == "range":
+            times, values = reader.read(series, start, end)
+            for t, v in zip(times, values):
+                print("%s\t%s\t%s"%(formatTime(t), name, v))
+        elif args.command == "stats":
+            stats = reader.stats(series, start, end)
+            if stats["count"]:
+                print("%s: count=%d min=%.2f max=%.2f mean=%.2f"%(name, stats["count"], stats["min"], stats["max"], stats["mean"]))
+            else:
+                print("%s: count=0"%(name))
+        elif args.command == "runtime":
+            print("%s: %.2f hours"%(name, reader.runtime(series, start, end)/3600.0))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@
 """
 Script to turn on/off outlets
 """
+import collections
 import datetime
 import glob
 import json
@@ -13,14 +14,24 @@ import pytz
 import serial
 import subprocess
 import sys
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from influxdb import InfluxDBClient
 
+from history import HistoryArchive
+from points import PointBuffer
+
 DEFAULT_SERIAL_DEVICE = "/dev/ttyUSB0"
 LOG_FILE = "~/logs/thermostat_outlet.log"
 CONFIG_FILE = os.path.expanduser("~/.outlet.config")
 INFLUXDB_CONFIG_FILE = os.path.expanduser("~/.influxdb.config")
+SERIAL_CACHE_FILE = os.path.expanduser("~/.outlet.serial")
 
 MULTI_LOOPS = 2
 ON_PAUSE = 20
@@ -34,9 +45,38 @@ CYCLE_COUNT = 2
 CYCLE_DELAY = datetime.timedelta(minutes=18)
 LOOP_DELAY = datetime.timedelta(minutes=5)
 FAILURE_THRESHOLD = datetime.timedelta(minutes=3)
-
-
-config = {
+# How often outlet states are read back from the Arduino and re-verified
+OUTLET_VERIFY_DELAY = datetime.timedelta(minutes=10)
+
+# Maximum number of telemetry points held while Influx is unreachable. Each
+# point costs 25 bytes, so the default tops out around 2.5MB.
+DEFAULT_BUFFER_POINTS = 100000
+# Points waiting for the writer thread to buffer them. This only fills up
+# while the writer is stuck on a slow Influx write.
+TELEMETRY_QUEUE_POINTS = 10000
+
+# Back off between Influx write attempts while it is unreachable, doubling
+# up to the maximum
+INFLUX_RETRY_DELAY = datetime.timedelta(seconds=30)
+INFLUX_MAX_RETRY_DELAY = datetime.timedelta(minutes=15)
+
+# Zones that haven't finished a loop in this long are reported as stalled
+ZONE_STALL_THRESHOLD = datetime.timedelta(minutes=15)
+ZONE_RESTART_DELAY = 30
+SUPERVISOR_DELAY = 30
+# Consecutive failed zone starts before the supervisor resets the USB bus
+# (single zone only) or, when every zone is failing, reboots the Pi
+ZONE_USB_RESET_FAILURES = 2
+ZONE_REBOOT_FAILURES = 5
+
+# Temperature filtering: median of the last N raw samples, then EWMA smoothing.
+# Only per-interval aggregates of the filtered value are sent to Influx.
+TEMP_MEDIAN_SAMPLES = 5
+TEMP_EWMA_ALPHA = 0.3
+TEMP_AGGREGATE_INTERVAL = datetime.timedelta(minutes=1)
+
+
+DEFAULT_CONFIG = {
     "heaters": {
         "heater_a": {
             "outlet": 'a',
@@ -78,11 +118,51 @@ config = {
 }
 
 
-def writeState(name, conf):
-    global config
-    config["heaters"][name] = conf
-    with open(CONFIG_FILE, "w") as f:
-        f.write(json.dumps(config, sort_keys=True, indent=4, separators=(',', ': ')))
+class StateStore(object):
+    '''
+    Owns the persisted config shared by every zone. A config without a
+    "zones" section is treated as a single zone named after its controller.
+    '''
+    def __init__(self, path, config):
+        self.Path = path
+        self.Config = config
+        self.Lock = threading.Lock()
+
+    @property
+    def Zones(self):
+        if "zones" in self.Config:
+            return self.Config["zones"]
+        return {self.Config["site"]["controller"]: self.Config}
+
+    def validate(self):
+        '''
+        Every zone must own its Arduino when there is more than one zone
+        '''
+        zones = self.Zones
+        if len(zones) < 2:
+            return
+
+        devices = {}
+        controllers = {}
+        for name, zone in sorted(zones.items()):
+            device = zone.get("serial_device")
+            if not device:
+                raise ValueError("Zone '%s' has no serial_device. It is required with more than one zone"%(name))
+            if device in devices:
+                raise ValueError("Zones '%s' and '%s' share serial_device '%s'"%(devices[device], name, device))
+            devices[device] = name
+
+            # The controller tag is what keeps each zone's telemetry apart
+            controller = zone["site"]["controller"]
+            if controller in controllers:
+                raise ValueError("Zones '%s' and '%s' share site controller '%s'"%(controllers[controller], name, controller))
+            controllers[controller] = name
+
+    def writeHeater(self, zone, name, conf):
+        with self.Lock:
+            self.Zones[zone]["heaters"][name] = conf
+            with open(self.Path, "w") as f:
+                f.write(json.dumps(self.Config, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
 def getNextDatetime(hour):
@@ -98,48 +178,147 @@ def getNextDatetime(hour):
     return datetime.datetime.combine(day, next_time)
 
 
+class SerialError(Exception):
+    pass
+
+
 class Arduino(object):
-    def __init__(self, log):
+    # Zones share the serial cache file
+    CacheLock = threading.Lock()
+    # Devices claimed by an Arduino in this process. Opening a port resets the
+    # board behind it, so a device held by another zone must never be opened.
+    DeviceLock = threading.Lock()
+    OpenDevices = {}
+
+    def __init__(self, log, device=None, probe=False):
         self.Log = log
+        self.Device = device
+        # Only probe every matching device when nothing else could own them
+        self.Probe = probe
+        self.SerialDevice = None
         self.Stream = None
+        # Last known state of each outlet. Missing outlets are unknown.
+        self.Outlets = {}
         self._newSerial()
 
     def _newSerial(self):
         '''
         Reset the serial device using the DTR lines
         '''
-        try:
-            self.Stream.close()
-        except:
-            pass
+        self.close()
+
+        # Opening the port resets the Arduino, which turns every outlet off
+        self.Outlets = {}
+
+        if self.Device is not None:
+            serial_devices = glob.glob(self.Device)
+        else:
+            serial_devices = glob.glob("/dev/ttyUSB*")
 
-        serial_devices = glob.glob("/dev/ttyUSB*")
+        with Arduino.DeviceLock:
+            serial_devices = [d for d in serial_devices if d not in Arduino.OpenDevices]
         if len(serial_devices) < 1:
-            self.Log.error("NO Serial devices detected. Restarting ...")
-            subprocess.call("sudo reboot", shell=True)
+            raise SerialError("NO free Serial devices detected matching %s"%(self.Device or "/dev/ttyUSB*"))
+
+        # Try the device that answered last time before falling back to discovery
+        candidates = []
+        cached = self._cachedDevice()
+        if cached in serial_devices:
+            candidates.append(cached)
+        for device in sorted(serial_devices, reverse=True):
+            if device not in candidates:
+                candidates.append(device)
+        if not self.Probe:
+            candidates = candidates[:1]
+
+        for i, device in enumerate(candidates):
+            if not self._claim(device):
+                continue
+
+            try:
+                self.Stream = serial.Serial(self.SerialDevice, 57600, timeout=1)
+                found = self._handshake()
+            except:
+                self.close()
+                raise
+
+            if found:
+                if device != cached:
+                    self._cacheDevice(device)
+                return
 
-        self.SerialDevice = sorted(serial_devices)[-1]
-        self.Stream = serial.Serial(self.SerialDevice, 57600, timeout=1)
+            # Keep the last device open, as before, so the zone can keep trying it
+            if i < len(candidates) - 1:
+                self.close()
 
+        # still not reset
+        self._cacheDevice(None)
+        self.Log.error("Failed to reset Serial!!!")
+
+    def _claim(self, device):
+        with Arduino.DeviceLock:
+            if device in Arduino.OpenDevices:
+                return False
+            Arduino.OpenDevices[device] = self
+        self.SerialDevice = device
+        return True
+
+    def _handshake(self):
         for x in range(5):
             self.Stream.write("I")
-            if self.Stream.readline().strip() == "I":
-                return
-            else:
+            response = self.Stream.readline().strip()
+            if response == "I":
+                return True
+            elif len(response) > 0:
+                # readline() already waited out the timeout if nothing came back
                 time.sleep(1)
+        return False
 
-        # still not reset
-        self.Log.error("Failed to reset Serial!!!")
+    def _cacheKey(self):
+        return self.Device or "default"
 
-    def resetSerial(self):
+    def _cachedDevice(self):
+        with Arduino.CacheLock:
+            try:
+                with open(SERIAL_CACHE_FILE) as f:
+                    return json.loads(f.read()).get(self._cacheKey())
+            except (IOError, OSError, ValueError):
+                return None
+
+    def _cacheDevice(self, device):
+        with Arduino.CacheLock:
+            try:
+                with open(SERIAL_CACHE_FILE) as f:
+                    cache = json.loads(f.read())
+            except (IOError, OSError, ValueError):
+                cache = {}
+
+            if device is None:
+                cache.pop(self._cacheKey(), None)
+            else:
+                cache[self._cacheKey()] = device
+
+            try:
+                with open(SERIAL_CACHE_FILE, "w") as f:
+                    f.write(json.dumps(cache))
+            except (IOError, OSError) as e:
+                self.Log.error("Failed to write serial cache: %s"%(e))
+
+    def close(self):
         try:
             self.Stream.close()
         except:
             pass
+        self.Stream = None
 
-        # FIXME: match device to the actual
-        subprocess.call("sudo ./usbreset /dev/bus/usb/001/002", shell=True, cwd=os.path.expanduser("~/"))
-        time.sleep(2)
+        with Arduino.DeviceLock:
+            if Arduino.OpenDevices.get(self.SerialDevice) is self:
+                del Arduino.OpenDevices[self.SerialDevice]
+        self.SerialDevice = None
+
+    def resetSerial(self):
+        # USB resets and reboots affect every zone, so they are left to the
+        # Supervisor. Here the port is only re-opened, which resets the board.
         self._newSerial()
 
     def _sendData(self, value):
@@ -165,14 +344,58 @@ class Arduino(object):
 
     def outletOn(self, outlet):
         if self._sendData(outlet.upper()) == str(outlet.upper()):
+            self.Outlets[outlet] = True
             return True
+        self.Outlets.pop(outlet, None)
         return False
 
     def outletOff(self, outlet):
         if self._sendData(outlet.lower()) == str(outlet.lower()):
+            self.Outlets[outlet] = False
             return True
+        self.Outlets.pop(outlet, None)
         return False
 
+    def setOutlets(self, states):
+        '''
+        Send several outlet commands in a single write. states maps each
+        outlet to True (on) or False (off).
+        '''
+        commands = "".join(o.upper() if on else o.lower() for o, on in sorted(states.items()))
+        try:
+            discard = self.Stream.readline()
+            while len(discard) > 0:
+                discard = self.Stream.readline()
+
+            self.Stream.write(commands)
+            # The Arduino acknowledges each command in order
+            for command in commands:
+                if self.Stream.readline().strip() == command:
+                    self.Outlets[command.lower()] = command.isupper()
+                else:
+                    self.Outlets.pop(command.lower(), None)
+        except Exception as e:
+            self.Log.error("Serial exception: %s"%(e), exc_info=1)
+            self.resetSerial()
+
+    def outletStates(self):
+        '''
+        Read every outlet state from the Arduino. Returns None if the firmware
+        doesn't support the status command.
+        '''
+        status = self._sendData('S')
+        if not status or not status.isalpha() or status.lower() != "abc":
+            return None
+        return dict((s.lower(), s.isupper()) for s in status)
+
+    def verifyOutlets(self):
+        states = self.outletStates()
+        if states is None:
+            # Without a status readback, forget everything so it gets re-sent
+            self.Outlets = {}
+        else:
+            self.Outlets = states
+
     def outletFeedback(self, feedback):
         if self._sendData(feedback) == '0':
             return True
@@ -197,15 +420,15 @@ class Arduino(object):
 
 
 class Heater(object):
-    def __init__(self, name, log, conf, influx, arduino):
+    def __init__(self, name, log, conf, influx, arduino, state, zone):
         self.Log = log
         self.Name = name
         self.Arduino = arduino
         self.Config = conf
         self.UpdateTime = None
         self.Influx = influx
-
-        self._off()
+        self.State = state
+        self.Zone = zone
 
     def startup(self):
         self.Log.info("%s Should be running? %s"%(self.Name, self.Running))
@@ -243,7 +466,7 @@ class Heater(object):
     @Used.setter
     def Used(self, value):
         self.Config["used"] = int(value)
-        writeState(self.Name, self.Config)
+        self.State.writeHeater(self.Zone, self.Name, self.Config)
 
     @property
     def Running(self):
@@ -252,7 +475,7 @@ class Heater(object):
     @Running.setter
     def Running(self, value):
         self.Config["running"] = value
-        writeState(self.Name, self.Config)
+        self.State.writeHeater(self.Zone, self.Name, self.Config)
 
     def _on(self):
         self.Arduino.outletOn(self.Outlet)
@@ -391,19 +614,62 @@ class TempSensor(object):
 
         self.Arduino = arduino
 
+        self.Window = collections.deque(maxlen=TEMP_MEDIAN_SAMPLES)
+        self.Filtered = None
+        self._resetAggregate()
+
+    def _resetAggregate(self):
+        self.AggregateStart = datetime.datetime.now()
+        self.Min = None
+        self.Max = None
+        self.Total = 0.0
+        self.Samples = 0
+        self.Errors = 0
+
+    def _sendAggregate(self):
+        self.Influx.sendMeasurement("working_dht22", "none", 0 if self.Errors else 1)
+        if self.Samples > 0:
+            self.Influx.sendMeasurement("temperature_fahrenheit", "none", self.Total/self.Samples)
+            self.Influx.sendMeasurement("temperature_fahrenheit_min", "none", self.Min)
+            self.Influx.sendMeasurement("temperature_fahrenheit_max", "none", self.Max)
+        self._resetAggregate()
+
+    def sample(self):
+        '''
+        Take one raw reading and push it through the filter. Returns True if
+        the reading was valid.
+        '''
+        t = self.Arduino.getTemp()
+        valid = type(t) is float
+        if valid:
+            # Median rejects single sample spikes, EWMA smooths what remains
+            self.Window.append(t)
+            median = sorted(self.Window)[len(self.Window)//2]
+            if self.Filtered is None:
+                self.Filtered = median
+            else:
+                self.Filtered = TEMP_EWMA_ALPHA*median + (1 - TEMP_EWMA_ALPHA)*self.Filtered
+            self.Last = self.Filtered
+
+            self.Min = self.Filtered if self.Min is None else min(self.Min, self.Filtered)
+            self.Max = self.Filtered if self.Max is None else max(self.Max, self.Filtered)
+            self.Total += self.Filtered
+            self.Samples += 1
+        else:
+            self.Log.error("%s - DHT error: %s"%(datetime.datetime.now(), t))
+            self.Errors += 1
+
+        if datetime.datetime.now() - self.AggregateStart >= TEMP_AGGREGATE_INTERVAL:
+            self._sendAggregate()
+        return valid
+
     @property
     def humidity(self):
         return self.Arduino.getHumidity()
 
     @property
     def fahrenheit(self):
-        t = self.Arduino.getTemp()
-        if type(t) is float:
-            self.Last = t
-            self.Influx.sendMeasurement("working_dht22", "none", 1)
-        else:
-            self.Log.error("%s - DHT error: %s"%(datetime.datetime.now(), t))
-            self.Influx.sendMeasurement("working_dht22", "none", 0)
+        if not self.sample():
             temp = self.Influx.queryCurrentTemp()
             if temp:
                 self.Last = temp
@@ -412,90 +678,223 @@ class TempSensor(object):
 
 
 class InfluxWrapper(object):
-    def __init__(self, log, influx_config, site_config):
-        self.Influx = InfluxDBClient(influx_config['host'],
-                                     influx_config['port'],
-                                     influx_config['login'],
-                                     influx_config['password'],
-                                     influx_config['database'],
-                                     ssl=True,
-                                     timeout=60)
+    '''
+    Telemetry pipe shared by every zone. Zones queue points without blocking
+    and a single writer thread batches them into Influx.
+    '''
+    def __init__(self, log, influx_config, archive=None):
+        # The client is created by connect() on the writer thread so zones
+        # can start while it comes up
+        self.Influx = None
+        self.Config = influx_config
         self.Log = log
-        self.Points = []
-        self.Location = site_config['location']
-        self.Controller = site_config['controller']
+        self.Queue = queue.Queue(maxsize=TELEMETRY_QUEUE_POINTS)
+        self.QueueLock = threading.Lock()
+        self.QueueDropped = 0
+        self.QueryLock = threading.Lock()
+        self.Archive = archive
+        self.Points = PointBuffer(influx_config.get('buffer_points', DEFAULT_BUFFER_POINTS))
         self.LastSent = datetime.datetime.now()
+        self.LastArchived = datetime.datetime.now()
+        self.ArchiveError = None
+        self.NextAttempt = None
+        self.RetryDelay = INFLUX_RETRY_DELAY
         self.Interval = influx_config['interval']
         self.MaxPoints = influx_config['max_points']
 
-    def getTime(self):
-        now = datetime.datetime.utcnow()
+    def connect(self):
+        self.Log.info("%s - Initializing Influx"%(datetime.datetime.now()))
+        client = InfluxDBClient(self.Config['host'],
+                                self.Config['port'],
+                                self.Config['login'],
+                                self.Config['password'],
+                                self.Config['database'],
+                                ssl=True,
+                                timeout=60)
+        try:
+            client.ping()
+        except Exception as e:
+            self.Log.error("Influxdb ping failure: %s"%(e))
+        with self.QueryLock:
+            self.Influx = client
+
+    def getTime(self, timestamp=None):
+        if timestamp is None:
+            now = datetime.datetime.utcnow()
+        else:
+            now = datetime.datetime.utcfromtimestamp(timestamp)
         return now.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    def queryCurrentTemp(self):
-        result = self.Influx.query('''SELECT "value" FROM "temperature_fahrenheit" WHERE ("location" = 'Greenhouse') AND time >= now() - 5m ORDER by time DESC LIMIT 1''')
+    def queryCurrentTemp(self, location, controller):
+        query = '''SELECT "value" FROM "temperature_fahrenheit" WHERE ("location" = '%s') AND ("controller" = '%s') AND time >= now() - 5m ORDER by time DESC LIMIT 1'''
+        result = self.query(query%(location, controller))
         points = [p for p in result]
         if len(points) > 0:
             return float(points[0][0]['value'])
         return None
 
-    def queryPreviousRuntime(self, hours_ago):
+    def queryPreviousRuntime(self, controller, hours_ago):
         query = '''SELECT "value" FROM "remaining_runtime" WHERE ("controller" = '%s') AND time >= now() - %dh AND time <= now() - %dh GROUP BY "outlet" ORDER BY time DESC LIMIT 1'''
-        result = self.Influx.query(query%(self.Controller, hours_ago + 1, hours_ago))
+        result = self.query(query%(controller, hours_ago + 1, hours_ago))
         points = [p for p in result]
         return [p[0]['value'] for p in points]
 
-    def writePoints(self):
+    def _batchPoints(self, batch):
+        points = []
+        for location, controller, measurement, outlet, value, timestamp in batch:
+            points.append({
+                "measurement": measurement,
+                "tags": {
+                    "location": location,
+                    "controller": controller,
+                    "outlet": outlet
+                },
+                "time": self.getTime(timestamp),
+                "fields": {
+                    "value": value
+                }
+            })
+        return points
+
+    def _writeBatch(self, batch):
         ret = None
-
-        # drop old points if there are too many
-        if len(self.Points) > self.MaxPoints:
-            self.Points = self.Points[self.MaxPoints:]
-
+        error = None
+        points = self._batchPoints(batch)
         for x in range(10):
             try:
-                ret = self.Influx.write_points(self.Points)
+                ret = self.Influx.write_points(points)
             except Exception as e:
-                self.Log.error("Influxdb point failure: %s"%(e))
+                error = e
                 ret = 0
             if ret:
-                self.Log.info("%s - Sent %d points to Influx"%(datetime.datetime.now(), len(self.Points)))
-                self.LastSent = datetime.datetime.now()
-                self.Points = []
                 return ret
 
             time.sleep(0.2)
 
-        self.Log.error("%s - Failed to send %d points to Influx: %s"%(datetime.datetime.now(), len(self.Points), ret))
+        if error is not None:
+            self.Log.error("Influxdb point failure: %s"%(error))
         return ret
 
-    def sendMeasurement(self, measurement, outlet, value):
-        point = {
-            "measurement": measurement,
-            "tags": {
-                "location": self.Location,
-                "controller": self.Controller,
-                "outlet": outlet
-            },
-            "time": self.getTime(),
-            "fields": {
-                "value": value
-            }
-        }
+    def writePoints(self):
+        ret = True
+        if self.Points.Dropped:
+            self.Log.error("%s - Dropped %d old points from the Influx buffer"%(datetime.datetime.now(), self.Points.Dropped))
+            self.Points.Dropped = 0
+        with self.QueueLock:
+            queue_dropped = self.QueueDropped
+            self.QueueDropped = 0
+        if queue_dropped:
+            self.Log.error("%s - Dropped %d points while the telemetry queue was full"%(datetime.datetime.now(), queue_dropped))
+
+        # Send the oldest points first, one batch at a time
+        sent = 0
+        while len(self.Points) > 0:
+            batch = self.Points.batch(self.MaxPoints)
+            ret = self._writeBatch(batch)
+            if not ret:
+                self.NextAttempt = datetime.datetime.now() + self.RetryDelay
+                self.Log.error("%s - Failed to send %d points to Influx: %s. Retrying at %s"%(datetime.datetime.now(), len(self.Points), ret, self.NextAttempt))
+                self.RetryDelay = min(self.RetryDelay*2, INFLUX_MAX_RETRY_DELAY)
+                return ret
+            sent += len(batch)
+            self.Points.consume(len(batch))
 
-        self.Points.append(point)
+        self.Log.info("%s - Sent %d points to Influx"%(datetime.datetime.now(), sent))
+        self.LastSent = datetime.datetime.now()
+        self.NextAttempt = None
+        self.RetryDelay = INFLUX_RETRY_DELAY
+        return ret
 
-        now = datetime.datetime.now()
-        if len(self.Points) >= self.MaxPoints or (now - self.LastSent).seconds >= self.Interval:
-            return self.writePoints()
+    def sendMeasurement(self, location, controller, measurement, outlet, value):
+        try:
+            self.Queue.put_nowait((location, controller, measurement, outlet, value, time.time()))
+        except queue.Full:
+            with self.QueueLock:
+                self.QueueDropped += 1
+            return False
         return True
 
+    def _bufferPoint(self, point):
+        try:
+            self.Points.append(*point)
+        except (TypeError, ValueError):
+            self.Log.error("%s - Dropping non-numeric %s point: %s"%(datetime.datetime.now(), point[2], point[4]))
+            return
+
+        if self.Archive is not None:
+            try:
+                self.Archive.append(*point)
+            except Exception as e:
+                # Reported by _flushArchive so a broken archive can't flood the log
+                self.ArchiveError = e
+
+    def _flushArchive(self):
+        if self.Archive is not None:
+            if self.Archive.Rejected:
+                self.Log.error("%s - History archive rejected %d points older than its newest (clock moved backwards?)"%(datetime.datetime.now(), self.Archive.Rejected))
+                self.Archive.Rejected = 0
+            if self.Archive.Dropped:
+                self.Log.error("%s - History archive dropped %d points it couldn't write"%(datetime.datetime.now(), self.Archive.Dropped))
+                self.Archive.Dropped = 0
+            try:
+                self.Archive.flush()
+            except Exception as e:
+                self.ArchiveError = e
+            if self.ArchiveError is not None:
+                self.Log.error("History archive failure: %s"%(self.ArchiveError))
+                self.ArchiveError = None
+
+    def run(self):
+        self.connect()
+        while True:
+            try:
+                self._bufferPoint(self.Queue.get(timeout=1))
+                while True:
+                    self._bufferPoint(self.Queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            now = datetime.datetime.now()
+            if (now - self.LastArchived).seconds >= self.Interval:
+                self.LastArchived = now
+                self._flushArchive()
+
+            if len(self.Points) >= self.MaxPoints or (now - self.LastSent).seconds >= self.Interval:
+                if self.NextAttempt is not None and now < self.NextAttempt:
+                    continue
+                if len(self.Points) > 0:
+                    self.writePoints()
+
     def query(self, *args, **kwargs):
-        return self.Influx.query(*args, **kwargs)
+        with self.QueryLock:
+            if self.Influx is None:
+                return []
+            return self.Influx.query(*args, **kwargs)
+
+
+class ZoneTelemetry(object):
+    '''
+    Per-zone handle on the shared InfluxWrapper that fills in the site tags
+    '''
+    def __init__(self, influx, site_config):
+        self.Influx = influx
+        self.Location = site_config['location']
+        self.Controller = site_config['controller']
+        # Fallback temperatures only ever come from this zone's own readings
+        self.TempLocation = site_config.get('temp_location', self.Location)
+
+    def sendMeasurement(self, measurement, outlet, value):
+        return self.Influx.sendMeasurement(self.Location, self.Controller, measurement, outlet, value)
+
+    def queryCurrentTemp(self):
+        return self.Influx.queryCurrentTemp(self.TempLocation, self.Controller)
+
+    def queryPreviousRuntime(self, hours_ago):
+        return self.Influx.queryPreviousRuntime(self.Controller, hours_ago)
 
 
 class HeatController(object):
-    def __init__(self, log, heaters, temp_sensor, influx, arduino, config):
+    def __init__(self, log, heaters, temp_sensor, influx, arduino, config, started=None):
         self.Log = log
         self.Heaters = heaters
         self.TempSensor = temp_sensor
@@ -503,6 +902,9 @@ class HeatController(object):
         self.Arduino = arduino
 
         self.OutletFails = {}
+        self.Heartbeat = datetime.datetime.now()
+        self.LastVerify = datetime.datetime.now()
+        self.Started = started
 
         self.Setpoint = config["temp_setpoint"]
         self.Tolerance = config["temp_tolerance"]
@@ -614,6 +1016,7 @@ class HeatController(object):
                 self.refueled()
                 return
 
+            self.TempSensor.sample()
             time.sleep(5)
             now = datetime.datetime.now()
             if (now - start).seconds >= length:
@@ -623,6 +1026,21 @@ class HeatController(object):
         for heater in self.Heaters:
             heater.updateRuntime()
 
+    def reconcileOutlets(self):
+        # Only send commands to outlets that aren't in the state they should be
+        now = datetime.datetime.now()
+        if now - self.LastVerify > OUTLET_VERIFY_DELAY:
+            self.LastVerify = now
+            self.Arduino.verifyOutlets()
+
+        for heater in self.Heaters:
+            if self.Arduino.Outlets.get(heater.Outlet) != heater.Running:
+                self.Log.info("%s - Reconciling %s to %s"%(datetime.datetime.now(), heater.Name, "On" if heater.Running else "Off"))
+                if heater.Running:
+                    heater._on()
+                else:
+                    heater._off()
+
     def getPreviousAvgRuntime(self, hours_ago):
         runtimes = self.Influx.queryPreviousRuntime(hours_ago)
         if runtimes:
@@ -666,10 +1084,10 @@ class HeatController(object):
 
         while True:
             now = datetime.datetime.now()
+            self.Heartbeat = now
             temp = self.TempSensor.fahrenheit
             humidity = self.TempSensor.humidity
             self.Log.info("%s - Current Temp: %.1f, humidity: %.1f"%(datetime.datetime.now(), temp, humidity))
-            self.Influx.sendMeasurement("temperature_fahrenheit", "none", temp)
             self.Influx.sendMeasurement("humidity_percentage", "none", humidity)
 
             # adjust running heaters
@@ -677,6 +1095,12 @@ class HeatController(object):
                 prev_loop = now
                 self.adjustHeat(temp)
 
+                if self.Started is not None:
+                    startup = (datetime.datetime.now() - self.Started).total_seconds()*1000
+                    self.Log.info("%s - First control decision %dms after start"%(datetime.datetime.now(), startup))
+                    self.Influx.sendMeasurement("startup_ms", "none", int(startup))
+                    self.Started = None
+
             # Cycle heaters that need it
             if now - prev_cycle > CYCLE_DELAY:
                 prev_cycle = now
@@ -704,14 +1128,149 @@ class HeatController(object):
             self.updateRuntimePrediction()
 
             # Force everything into the state it should be
-            for heater in self.Heaters:
-                if heater.Running:
-                    heater._on()
-                else:
-                    heater._off()
+            self.reconcileOutlets()
 
             self.refuelCheck(60)
 
+class ZoneLog(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return "[%s] %s"%(self.extra["zone"], msg), kwargs
+
+
+class Zone(object):
+    '''
+    One heated zone: its own Arduino, heaters, sensor and controller
+    '''
+    def __init__(self, name, log, config, influx, state, refuel=False, started=None, probe=False):
+        self.Name = name
+        self.Log = ZoneLog(log, {"zone": name})
+        self.Config = config
+        self.Influx = influx
+        self.State = state
+        self.Refuel = refuel
+        self.Started = started
+        self.Probe = probe
+        self.Controller = None
+        self.Arduino = None
+        self.Thread = None
+        # Consecutive starts that failed before reaching the run loop
+        self.Failures = 0
+
+    def setup(self):
+        telemetry = ZoneTelemetry(self.Influx, self.Config['site'])
+
+        # Release the port held by a previous run before opening it again
+        if self.Arduino is not None:
+            self.Arduino.close()
+            self.Arduino = None
+
+        self.Log.info("%s - Initializing Arduino"%(datetime.datetime.now()))
+        device = self.Config.get("serial_device")
+        arduino = Arduino(self.Log, device, self.Probe and device is None)
+        self.Arduino = arduino
+
+        self.Log.info("%s - Setting up heater objects"%(datetime.datetime.now()))
+        heaters = []
+        for name, conf in self.Config["heaters"].items():
+            heaters.append(Heater(name, self.Log, conf, telemetry, arduino, self.State, self.Name))
+        arduino.setOutlets(dict((heater.Outlet, False) for heater in heaters))
+
+        self.Log.info("%s - Initializing Temp Sensor"%(datetime.datetime.now()))
+        temp_sensor = TempSensor(self.Config["dht22"]["pin"], telemetry, arduino, self.Log)
+
+        self.Controller = HeatController(self.Log, heaters, temp_sensor, telemetry, arduino, self.Config, self.Started)
+        self.Started = None
+        if self.Refuel:
+            self.Refuel = False
+            self.Controller.refueled()
+
+        self.Controller.startup()
+
+    def run(self):
+        try:
+            self.setup()
+        except Exception as e:
+            self.Failures += 1
+            self.Log.error("Zone setup failed (%d in a row): %s"%(self.Failures, e), exc_info=1)
+            return
+
+        self.Failures = 0
+        try:
+            self.Log.info("%s - ENTERING RUN LOOP"%(datetime.datetime.now()))
+            self.Controller.run()
+        except Exception as e:
+            self.Log.error("Zone loop failed: %s"%(e), exc_info=1)
+
+    def start(self):
+        if self.Started is None:
+            self.Started = datetime.datetime.now()
+        self.Thread = threading.Thread(target=self.run, name=self.Name)
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    @property
+    def Alive(self):
+        return self.Thread is not None and self.Thread.is_alive()
+
+    @property
+    def Stalled(self):
+        if self.Controller is None:
+            return False
+        return datetime.datetime.now() - self.Controller.Heartbeat > ZONE_STALL_THRESHOLD
+
+
+class Supervisor(object):
+    '''
+    Runs every zone in its own thread and restarts zones whose loop has died.
+    A zone blocked on its serial port only stalls itself. USB resets and
+    reboots affect every zone, so only the supervisor decides on them.
+    '''
+    def __init__(self, log, zones, influx):
+        self.Log = log
+        self.Zones = zones
+        self.Influx = influx
+
+    def resetUsb(self):
+        # FIXME: match device to the actual
+        self.Log.error("%s - Resetting USB"%(datetime.datetime.now()))
+        subprocess.call("sudo ./usbreset /dev/bus/usb/001/002", shell=True, cwd=os.path.expanduser("~/"))
+        time.sleep(2)
+
+    def restartZone(self, zone):
+        if all(z.Failures >= ZONE_REBOOT_FAILURES for z in self.Zones):
+            self.Log.error("############ ALL ZONES FAILING. REBOOTING ###########")
+            subprocess.call("sudo reboot", shell=True)
+            return
+
+        self.Log.error("%s - Zone %s died. Restarting..."%(datetime.datetime.now(), zone.Name))
+        time.sleep(ZONE_RESTART_DELAY)
+        # The USB device path isn't tied to a zone, so only reset it when
+        # there is a single zone that could own it
+        if len(self.Zones) == 1 and zone.Failures >= ZONE_USB_RESET_FAILURES:
+            self.resetUsb()
+        zone.start()
+
+    def run(self):
+        telemetry = threading.Thread(target=self.Influx.run, name="telemetry")
+        telemetry.daemon = True
+        telemetry.start()
+
+        for zone in self.Zones:
+            zone.start()
+
+        while True:
+            time.sleep(SUPERVISOR_DELAY)
+            if not telemetry.is_alive():
+                self.Log.error("%s - Telemetry writer died"%(datetime.datetime.now()))
+                return 1
+
+            for zone in self.Zones:
+                if not zone.Alive:
+                    self.restartZone(zone)
+                elif zone.Stalled:
+                    self.Log.error("%s - Zone %s has stalled since %s"%(datetime.datetime.now(), zone.Name, zone.Controller.Heartbeat))
+
+
 def reboot(log):
     if os.path.isfile(os.path.expanduser("~/.reboot")):
         os.remove(os.path.expanduser("~/.reboot"))
@@ -725,6 +1284,7 @@ def reboot(log):
 
 
 def main():
+    started = datetime.datetime.now()
     log = logging.getLogger('OutletThermostatLogger')
     log.setLevel(logging.INFO)
     log_file = os.path.realpath(os.path.expanduser(LOG_FILE))
@@ -742,48 +1302,46 @@ def main():
         influx_config = json.loads(f.read())
 
     # Handle start state
-    global config
-
     if os.path.isfile(CONFIG_FILE):
         with open(CONFIG_FILE) as f:
             config = json.loads(f.read())
     else:
         log.error("No config file '%s' found. Defaulting to builtin config"%(CONFIG_FILE))
+        config = DEFAULT_CONFIG
+    state = StateStore(CONFIG_FILE, config)
+    try:
+        state.validate()
+    except ValueError as e:
+        log.error("Invalid config '%s': %s"%(CONFIG_FILE, e))
+        return 1
 
-    log.info("%s - Initializing Influx"%(datetime.datetime.now()))
-    influx = InfluxWrapper(log, influx_config, config['site'])
-
-    log.info("%s - Initializing Arduino"%(datetime.datetime.now()))
-    arduino = Arduino(log)
-
-    log.info("%s - Setting up heater objects"%(datetime.datetime.now()))
-    heaters = []
-    for name, conf in config["heaters"].items():
-        heaters.append(Heater(name, log, conf, influx, arduino))
-
+    # The archive is optional, it must never stop the heaters from starting
+    try:
+        archive = HistoryArchive()
+    except Exception as e:
+        log.error("History archive disabled: %s"%(e), exc_info=1)
+        archive = None
 
-    log.info("%s - Initializing Temp Sensor"%(datetime.datetime.now()))
-    temp_sensor = TempSensor(config["dht22"]["pin"], influx, arduino, log)
+    influx = InfluxWrapper(log, influx_config, archive)
 
-    controller = HeatController(log, heaters, temp_sensor, influx, arduino, config)
+    refuel = False
     if not os.path.isfile(os.path.expanduser("~/.refueled4")):
         with open(os.path.expanduser("~/.refueled4"), "w") as f:
             f.write("%s\n"%(datetime.datetime.now()))
-        controller.refueled()
-
-    # import pdb
-    # pdb.set_trace()
+        refuel = True
 
-    controller.startup()
+    zones = []
+    probe = len(state.Zones) == 1
+    for name, zone_config in sorted(state.Zones.items()):
+        zones.append(Zone(name, log, zone_config, influx, state, refuel, started, probe))
 
     ######################################################
-    log.info("%s - ENTERING RUN LOOP"%(datetime.datetime.now()))
+    log.info("%s - Starting %d zone(s)"%(datetime.datetime.now(), len(zones)))
     try:
-        controller.run()
+        return Supervisor(log, zones, influx).run()
     except Exception as e:
-        log.error("Main loop failed: %s"%(e), exc_info=1)
+        log.error("Supervisor failed: %s"%(e), exc_info=1)
         return 1
-    return 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+"""
+Compact, fixed capacity storage for telemetry points waiting to be sent
+"""
+import array
+
+
+class PointBatch(object):
+    '''
+    Read-only view over a contiguous run of points in a PointBuffer. Nothing
+    is copied until the points are iterated.
+    '''
+    __slots__ = ("Buffer", "Start", "Count")
+
+    def __init__(self, buffer, start, count):
+        self.Buffer = buffer
+        self.Start = start
+        self.Count = count
+
+    def __len__(self):
+        return self.Count
+
+    def __iter__(self):
+        b = self.Buffer
+        for i in range(self.Start, self.Start + self.Count):
+            value = b.Values[i]
+            if b.Integers[i]:
+                value = int(value)
+            yield (b.Names[b.Locations[i]], b.Names[b.Controllers[i]],
+                   b.Names[b.Measurements[i]], b.Names[b.Outlets[i]], value, b.Times[i])
+
+
+class PointBuffer(object):
+    '''
+    Fixed capacity ring buffer of telemetry points stored as parallel arrays.
+    Tag and measurement names are interned to small integer ids. When the
+    buffer is full the oldest point is evicted to make room for the newest.
+    '''
+    def __init__(self, capacity):
+        self.Capacity = capacity
+        self.Names = []
+        self.NameIds = {}
+        self.Locations = array.array('H', [0]) * capacity
+        self.Controllers = array.array('H', [0]) * capacity
+        self.Measurements = array.array('H', [0]) * capacity
+        self.Outlets = array.array('H', [0]) * capacity
+        self.Values = array.array('d', [0.0]) * capacity
+        self.Integers = array.array('B', [0]) * capacity
+        self.Times = array.array('d', [0.0]) * capacity
+        self.Head = 0
+        self.Count = 0
+        self.Dropped = 0
+
+    def __len__(self):
+        return self.Count
+
+    def _intern(self, name):
+        name = str(name)
+        if name not in self.NameIds:
+            self.NameIds[name] = len(self.Names)
+            self.Names.append(name)
+        return self.NameIds[name]
+
+    def append(self, location, controller, measurement, outlet, value, timestamp):
+        number = float(value)
+        if self.Count >= self.Capacity:
+            # Evict the oldest point
+            self.Head = (self.Head + 1) % self.Capacity
+            self.Count -= 1
+            self.Dropped += 1
+
+        i = (self.Head + self.Count) % self.Capacity
+        self.Locations[i] = self._intern(location)
+        self.Controllers[i] = self._intern(controller)
+        self.Measurements[i] = self._intern(measurement)
+        self.Outlets[i] = self._intern(outlet)
+        self.Values[i] = number
+        self.Integers[i] = 1 if isinstance(value, int) else 0
+        self.Times[i] = timestamp
+        self.Count += 1
+
+    def batch(self, size):
+        '''
+        Oldest points first, up to size. The batch stops at the end of the
+        underlying arrays so it may be shorter than size when wrapping.
+        '''
+        count = min(size, self.Count, self.Capacity - self.Head)
+        return PointBatch(self, self.Head, count)
+
+    def consume(self, count):
+        count = min(count, self.Count)
+        self.Head = (self.Head + count) % self.Capacity
+        self.Count -= count
@@ -70,6 +70,13 @@ void feedback(uint8_t pin) {
     Serial.println(1);
 }
 
+void outletStatus() {
+    // Uppercase letters are outlets that are on, lowercase are off
+    Serial.print(digitalRead(OUTLET_A) ? 'A' : 'a');
+    Serial.print(digitalRead(OUTLET_B) ? 'B' : 'b');
+    Serial.println(digitalRead(OUTLET_C) ? 'C' : 'c');
+}
+
 void setup() {
     pinMode(DHT22_POWER, OUTPUT);
     digitalWrite(DHT22_POWER, HIGH);
@@ -178,6 +185,10 @@ void loop() {
                 Serial.println('c');
                 break;
 
+            case 'S':
+                outletStatus();
+                break;
+
             // Feedback sensors
             case '1':
                 feedback(FEEDBACK_A);
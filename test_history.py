@@ -0,0 +1,171 @@
+import os
+
+import pytest
+
+import history
+
+from history import HistoryArchive, HistoryReader, ITEM_SIZE, TIME_COLUMN, VALUE_COLUMN, segmentName
+
+DAY = 24*3600
+# 2019-01-01T00:00:00Z
+START = 1546300800.0
+
+
+def append(archive, measurement, outlet, value, timestamp):
+    return archive.append("greenhouse", "controller1", measurement, outlet, value, timestamp)
+
+
+def test_range_is_half_open(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    for i in range(10):
+        append(archive, "temperature_fahrenheit", "none", 50 + i, START + i*60)
+    archive.flush()
+
+    reader = HistoryReader(str(tmpdir))
+    series = reader.findSeries("temperature_fahrenheit")
+    assert series == [0]
+
+    times, values = reader.read(0, START + 2*60, START + 5*60)
+    assert list(times) == [START + 120, START + 180, START + 240]
+    assert list(values) == [52.0, 53.0, 54.0]
+
+
+def test_range_spans_segments(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    for day in range(3):
+        append(archive, "temperature_fahrenheit", "none", day, START + day*DAY)
+    archive.flush()
+
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        [segmentName(START + day*DAY) for day in range(3)] + ["series.json"])
+
+    reader = HistoryReader(str(tmpdir))
+    times, values = reader.read(0, START, START + 3*DAY)
+    assert list(values) == [0.0, 1.0, 2.0]
+
+    stats = reader.stats(0, START, START + 3*DAY)
+    assert stats == {"count": 3, "min": 0.0, "max": 2.0, "mean": 1.0}
+
+
+def test_series_ids_survive_reopen(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    append(archive, "running_heater", "heater_a", 1, START)
+    append(archive, "running_heater", "heater_b", 0, START)
+    archive.flush()
+
+    archive = HistoryArchive(str(tmpdir))
+    append(archive, "running_heater", "heater_b", 1, START + 60)
+    archive.flush()
+
+    reader = HistoryReader(str(tmpdir))
+    assert reader.findSeries("running_heater", "heater_b") == [1]
+    assert list(reader.read(1, START, START + 120)[1]) == [0.0, 1.0]
+
+
+def test_runtime_skips_gaps(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    # On for 3 minutes, off for 2, then on again after a 30 minute gap
+    samples = [(0, 1), (60, 1), (120, 1), (180, 0), (240, 0), (300, 1), (2100, 1)]
+    for t, running in samples:
+        append(archive, "running_heater", "heater_a", running, START + t)
+    archive.flush()
+
+    reader = HistoryReader(str(tmpdir))
+    assert reader.runtime(0, START, START + DAY) == 180.0
+
+
+def test_older_points_are_rejected(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    for t in (100, 200, 300):
+        assert append(archive, "temperature_fahrenheit", "none", t, START + t)
+    assert not append(archive, "temperature_fahrenheit", "none", 50, START + 50)
+    archive.flush()
+
+    # The newest time is read back from disk after a restart
+    archive = HistoryArchive(str(tmpdir))
+    assert not append(archive, "temperature_fahrenheit", "none", 60, START + 60)
+    assert append(archive, "temperature_fahrenheit", "none", 400, START + 400)
+    archive.flush()
+    assert archive.Rejected == 1
+
+    reader = HistoryReader(str(tmpdir))
+    times, values = reader.read(0, START, START + 1000)
+    assert list(values) == [100.0, 200.0, 300.0, 400.0]
+
+
+def test_repair_trims_partial_rows(tmpdir):
+    archive = HistoryArchive(str(tmpdir))
+    for i in range(3):
+        append(archive, "temperature_fahrenheit", "none", i, START + i)
+    archive.flush()
+
+    # Simulate a crash after the time column was written but not the value
+    prefix = os.path.join(str(tmpdir), segmentName(START), "0")
+    with open(prefix + TIME_COLUMN, "ab") as f:
+        f.write(b"\0"*(ITEM_SIZE + 3))
+
+    archive = HistoryArchive(str(tmpdir))
+    append(archive, "temperature_fahrenheit", "none", 10, START + 10)
+    archive.flush()
+
+    assert os.path.getsize(prefix + TIME_COLUMN) == 4*ITEM_SIZE
+    assert os.path.getsize(prefix + VALUE_COLUMN) == 4*ITEM_SIZE
+
+    reader = HistoryReader(str(tmpdir))
+    times, values = reader.read(0, START, START + 100)
+    assert list(times) == [START, START + 1, START + 2, START + 10]
+    assert list(values) == [0.0, 1.0, 2.0, 10.0]
+
+
+def test_failed_flush_keeps_columns_paired(tmpdir, monkeypatch):
+    archive = HistoryArchive(str(tmpdir))
+    append(archive, "temperature_fahrenheit", "none", 10, START)
+    append(archive, "humidity_percentage", "none", 20, START)
+    archive.flush()
+    append(archive, "temperature_fahrenheit", "none", 30, START + 60)
+    append(archive, "humidity_percentage", "none", 40, START + 60)
+
+    # The value column of the second series fails after its time column was written
+    real_open = open
+
+    def failing_open(filename, mode="r"):
+        if filename.endswith(os.path.join(segmentName(START), "1" + VALUE_COLUMN)) and mode == "ab":
+            raise IOError("No space left on device")
+        return real_open(filename, mode)
+
+    monkeypatch.setattr(history, "open", failing_open, raising=False)
+    with pytest.raises(IOError):
+        archive.flush()
+    monkeypatch.undo()
+
+    assert archive.PendingCount == 1
+    archive.flush()
+
+    reader = HistoryReader(str(tmpdir))
+    for series, expected in ((0, [10.0, 30.0]), (1, [20.0, 40.0])):
+        times, values = reader.read(series, START, START + DAY)
+        assert list(times) == [START, START + 60]
+        assert list(values) == expected
+
+
+def test_pending_is_capped_while_flushes_fail(tmpdir, monkeypatch):
+    monkeypatch.setattr(history, "FLUSH_POINTS", 2)
+    monkeypatch.setattr(history, "MAX_PENDING_POINTS", 4)
+    archive = HistoryArchive(str(tmpdir))
+    append(archive, "temperature_fahrenheit", "none", 0, START)
+
+    def failing_open(filename, mode="r"):
+        raise IOError("No space left on device")
+
+    monkeypatch.setattr(history, "open", failing_open, raising=False)
+    for i in range(1, 10):
+        assert append(archive, "temperature_fahrenheit", "none", i, START + i)
+    assert archive.PendingCount == 4
+    assert archive.Dropped == 6
+    with pytest.raises(IOError):
+        archive.flush()
+
+    monkeypatch.delattr(history, "open")
+    archive.flush()
+    reader = HistoryReader(str(tmpdir))
+    assert list(reader.read(0, START, START + DAY)[1]) == [6.0, 7.0, 8.0, 9.0]
@@ -0,0 +1,280 @@
+import copy
+import logging
+
+import pytest
+
+import outlet
+
+
+def zone_config(device, controller):
+    config = copy.deepcopy(outlet.DEFAULT_CONFIG)
+    config["serial_device"] = device
+    config["site"]["controller"] = controller
+    return config
+
+
+def test_single_zone_config_is_valid():
+    outlet.StateStore("unused", copy.deepcopy(outlet.DEFAULT_CONFIG)).validate()
+
+
+def test_zones_need_distinct_devices_and_controllers():
+    config = {"zones": {
+        "one": zone_config("/dev/serial/by-id/one", "controller1"),
+        "two": zone_config("/dev/serial/by-id/two", "controller2"),
+    }}
+    outlet.StateStore("unused", config).validate()
+
+    del config["zones"]["two"]["serial_device"]
+    with pytest.raises(ValueError):
+        outlet.StateStore("unused", config).validate()
+
+    config["zones"]["two"]["serial_device"] = "/dev/serial/by-id/one"
+    with pytest.raises(ValueError):
+        outlet.StateStore("unused", config).validate()
+
+    config["zones"]["two"] = zone_config("/dev/serial/by-id/two", "controller1")
+    with pytest.raises(ValueError):
+        outlet.StateStore("unused", config).validate()
+
+
+INFLUX_CONFIG = {
+    "host": "localhost",
+    "port": 8086,
+    "login": "",
+    "password": "",
+    "database": "test",
+    "interval": 60,
+    "max_points": 100,
+}
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.Queries = []
+
+    def query(self, query):
+        self.Queries.append(query)
+        return []
+
+
+def test_fallback_temp_is_limited_to_the_zone():
+    influx = outlet.InfluxWrapper(logging.getLogger(), INFLUX_CONFIG)
+    influx.Influx = FakeClient()
+    telemetry = outlet.ZoneTelemetry(influx, {"location": "greenhouse2", "controller": "controller2"})
+
+    assert telemetry.queryCurrentTemp() is None
+    query = influx.Influx.Queries[0]
+    assert "\"location\" = 'greenhouse2'" in query
+    assert "\"controller\" = 'controller2'" in query
+
+
+def test_telemetry_queue_is_bounded(monkeypatch):
+    monkeypatch.setattr(outlet, "TELEMETRY_QUEUE_POINTS", 3)
+    influx = outlet.InfluxWrapper(logging.getLogger(), INFLUX_CONFIG)
+    for i in range(5):
+        influx.sendMeasurement("greenhouse", "controller1", "temperature_fahrenheit", "none", float(i))
+    assert influx.Queue.qsize() == 3
+    assert influx.QueueDropped == 2
+
+
+class FakeFirmware(object):
+    '''
+    Answers serial commands the way src/thermostatOutlet.ino does
+    '''
+    def __init__(self, device, *args, **kwargs):
+        self.Outlets = {"a": False, "b": False, "c": False}
+        self.Lines = []
+        self.Writes = []
+        self.OldFirmware = False
+        # Commands whose acknowledgement comes back wrong
+        self.BadAcks = set()
+        FakeFirmware.Last = self
+
+    def write(self, data):
+        self.Writes.append(data)
+        for command in data:
+            if command == "I":
+                self.Lines.append("I")
+            elif command == "S" and not self.OldFirmware:
+                self.Lines.append("".join(o.upper() if on else o for o, on in sorted(self.Outlets.items())))
+            elif command.lower() in self.Outlets:
+                self.Outlets[command.lower()] = command.isupper()
+                self.Lines.append("E" if command in self.BadAcks else command)
+            else:
+                self.Lines.append("E")
+
+    def readline(self):
+        if self.Lines:
+            return self.Lines.pop(0) + "\r\n"
+        return ""
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def controller(tmpdir, monkeypatch):
+    monkeypatch.setattr(outlet, "SERIAL_CACHE_FILE", str(tmpdir.join("serial")))
+    monkeypatch.setattr(outlet.serial, "Serial", FakeFirmware)
+    monkeypatch.setattr(outlet.glob, "glob", lambda pattern: [pattern])
+    log = logging.getLogger()
+
+    arduino = outlet.Arduino(log, "/dev/serial/by-id/fake")
+    config = copy.deepcopy(outlet.DEFAULT_CONFIG)
+    heaters = []
+    for name, conf in sorted(config["heaters"].items()):
+        heaters.append(outlet.Heater(name, log, conf, None, arduino, None, "zone"))
+    arduino.setOutlets(dict((heater.Outlet, False) for heater in heaters))
+
+    controller = outlet.HeatController(log, heaters, None, None, arduino, config)
+    yield controller
+    arduino.close()
+
+
+def firmware_writes(firmware):
+    writes = firmware.Writes
+    firmware.Writes = []
+    return writes
+
+
+def test_initial_states_go_out_in_one_write(controller):
+    firmware = FakeFirmware.Last
+    assert firmware.Writes[-1] == "abc"
+    assert controller.Arduino.Outlets == {"a": False, "b": False, "c": False}
+
+
+def test_reconcile_sends_nothing_when_states_match(controller):
+    firmware = FakeFirmware.Last
+    firmware_writes(firmware)
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == []
+
+
+def test_reconcile_sends_only_diverged_outlets(controller):
+    firmware = FakeFirmware.Last
+    firmware_writes(firmware)
+    controller.Heaters[1].Config["running"] = True
+
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == ["B"]
+    assert firmware.Outlets["b"]
+
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == []
+
+
+def test_reconcile_resends_after_a_bad_ack(controller):
+    firmware = FakeFirmware.Last
+    firmware_writes(firmware)
+    firmware.BadAcks.add("A")
+    controller.Heaters[0].Config["running"] = True
+
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == ["A"]
+    assert "a" not in controller.Arduino.Outlets
+
+    firmware.BadAcks.clear()
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == ["A"]
+    assert controller.Arduino.Outlets["a"]
+
+
+def test_verify_sweep_fixes_outlets_changed_elsewhere(controller):
+    firmware = FakeFirmware.Last
+    firmware_writes(firmware)
+    firmware.Outlets["c"] = True
+
+    # Not noticed until the verify sweep
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == []
+
+    controller.LastVerify -= outlet.OUTLET_VERIFY_DELAY*2
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == ["S", "c"]
+    assert not firmware.Outlets["c"]
+
+
+def test_verify_sweep_resends_everything_on_old_firmware(controller):
+    firmware = FakeFirmware.Last
+    firmware_writes(firmware)
+    firmware.OldFirmware = True
+    controller.Heaters[2].Config["running"] = True
+
+    controller.LastVerify -= outlet.OUTLET_VERIFY_DELAY*2
+    controller.reconcileOutlets()
+    assert firmware_writes(firmware) == ["S", "a", "b", "C"]
+    assert controller.Arduino.Outlets == {"a": False, "b": False, "c": True}
+
+
+class FakeSensorArduino(object):
+    def __init__(self, readings):
+        self.Readings = list(readings)
+
+    def getTemp(self):
+        return self.Readings.pop(0)
+
+
+class FakeTelemetry(object):
+    def __init__(self):
+        self.Points = []
+        self.CurrentTemp = None
+
+    def sendMeasurement(self, measurement, outlet, value):
+        self.Points.append((measurement, outlet, value))
+
+    def queryCurrentTemp(self):
+        return self.CurrentTemp
+
+
+def sensor(readings):
+    return outlet.TempSensor(21, FakeTelemetry(), FakeSensorArduino(readings), logging.getLogger())
+
+
+def test_median_rejects_a_single_spike():
+    temp_sensor = sensor([60.0, 60.0, 95.0, 60.0])
+    for x in range(4):
+        temp_sensor.sample()
+    assert temp_sensor.Filtered == pytest.approx(60.0)
+    assert temp_sensor.Max == pytest.approx(60.0)
+
+
+def test_ewma_smooths_toward_new_readings():
+    temp_sensor = sensor([60.0, 70.0])
+    assert temp_sensor.fahrenheit == 60.0
+    # Median of [60, 70] is 70, blended in at TEMP_EWMA_ALPHA
+    expected = outlet.TEMP_EWMA_ALPHA*70.0 + (1 - outlet.TEMP_EWMA_ALPHA)*60.0
+    assert temp_sensor.fahrenheit == pytest.approx(expected)
+
+
+def test_aggregates_sent_once_per_interval():
+    temp_sensor = sensor([60.0, 61.0, 62.0, 63.0])
+    filtered = []
+    for x in range(3):
+        temp_sensor.sample()
+        filtered.append(temp_sensor.Filtered)
+    assert temp_sensor.Influx.Points == []
+
+    temp_sensor.AggregateStart -= outlet.TEMP_AGGREGATE_INTERVAL
+    temp_sensor.sample()
+    filtered.append(temp_sensor.Filtered)
+
+    points = dict((p[0], p[2]) for p in temp_sensor.Influx.Points)
+    assert len(temp_sensor.Influx.Points) == 4
+    assert points["working_dht22"] == 1
+    assert points["temperature_fahrenheit"] == pytest.approx(sum(filtered)/len(filtered))
+    assert points["temperature_fahrenheit_min"] == pytest.approx(min(filtered))
+    assert points["temperature_fahrenheit_max"] == pytest.approx(max(filtered))
+    assert temp_sensor.Samples == 0
+
+
+def test_errors_mark_the_interval_and_fall_back():
+    temp_sensor = sensor([60.0, "DHT22 Time out error,", "DHT22 Time out error,"])
+    temp_sensor.fahrenheit
+    temp_sensor.Influx.CurrentTemp = 58.5
+    assert temp_sensor.fahrenheit == 58.5
+
+    temp_sensor.AggregateStart -= outlet.TEMP_AGGREGATE_INTERVAL
+    temp_sensor.sample()
+    points = dict((p[0], p[2]) for p in temp_sensor.Influx.Points)
+    assert points["working_dht22"] == 0
+    assert points["temperature_fahrenheit"] == pytest.approx(60.0)
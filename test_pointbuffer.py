@@ -0,0 +1,87 @@
+import pytest
+
+from points import PointBuffer
+
+
+def fill(buffer, count, start=0):
+    for i in range(start, start + count):
+        buffer.append("greenhouse", "controller1", "temp", "none", float(i), 1000.0 + i)
+
+
+def values(batch):
+    return [p[4] for p in batch]
+
+
+def drain(buffer):
+    drained = []
+    while len(buffer) > 0:
+        batch = buffer.batch(10)
+        drained.extend(values(batch))
+        buffer.consume(len(batch))
+    return drained
+
+
+def test_append_and_batch_oldest_first():
+    buffer = PointBuffer(5)
+    fill(buffer, 3)
+    assert len(buffer) == 3
+    assert values(buffer.batch(10)) == [0.0, 1.0, 2.0]
+    assert values(buffer.batch(2)) == [0.0, 1.0]
+
+
+def test_eviction_drops_oldest():
+    buffer = PointBuffer(4)
+    fill(buffer, 6)
+    assert len(buffer) == 4
+    assert buffer.Dropped == 2
+    assert drain(buffer) == [2.0, 3.0, 4.0, 5.0]
+
+
+def test_batch_stops_at_wrap_and_consume_continues():
+    buffer = PointBuffer(4)
+    fill(buffer, 4)
+    buffer.consume(3)
+    fill(buffer, 2, start=4)
+
+    # Head is at index 3, so the first batch only reaches the end of the arrays
+    first = buffer.batch(10)
+    assert values(first) == [3.0]
+    buffer.consume(len(first))
+
+    second = buffer.batch(10)
+    assert values(second) == [4.0, 5.0]
+    buffer.consume(len(second))
+    assert len(buffer) == 0
+    assert len(buffer.batch(10)) == 0
+
+
+def test_consume_more_than_count():
+    buffer = PointBuffer(4)
+    fill(buffer, 2)
+    buffer.consume(10)
+    assert len(buffer) == 0
+
+
+def test_integer_values_round_trip():
+    buffer = PointBuffer(4)
+    buffer.append("greenhouse", "controller1", "working_outlet", "heater_a", 1, 1000.0)
+    buffer.append("greenhouse", "controller1", "temp", "none", 1.0, 1001.0)
+    points = list(buffer.batch(10))
+    assert points[0] == ("greenhouse", "controller1", "working_outlet", "heater_a", 1, 1000.0)
+    assert type(points[0][4]) is int
+    assert type(points[1][4]) is float
+
+
+def test_names_are_interned():
+    buffer = PointBuffer(4)
+    fill(buffer, 4)
+    assert sorted(buffer.Names) == ["controller1", "greenhouse", "none", "temp"]
+
+
+def test_non_numeric_value_does_not_evict():
+    buffer = PointBuffer(2)
+    fill(buffer, 2)
+    with pytest.raises(ValueError):
+        buffer.append("greenhouse", "controller1", "humidity", "none", "DHT error", 2000.0)
+    assert buffer.Dropped == 0
+    assert values(buffer.batch(10)) == [0.0, 1.0]
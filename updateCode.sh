@@ -1,11 +1,11 @@
 #! /bin/bash
 
 
-PREV_MD5=`md5sum outlet.py`
+PREV_MD5=`cat *.py | md5sum`
 git fetch origin master
 git reset --hard FETCH_HEAD
 git clean -df
-NEW_MD5=`md5sum outlet.py`
+NEW_MD5=`cat *.py | md5sum`
 
 
 echo $PREV_MD5